@@ -19,33 +19,65 @@
 
 import argparse
 import asyncio
+import atexit
+import faulthandler
 import logging
 import logging.handlers
 import os
+import queue
 import signal
 import sys
 import threading
-import traceback
-from functools import partial
 from signal import SIGINT, SIGTERM
 
+import orjson
 import structlog
 
 from .metrics import Metrics
 
+# Log file writes are buffered up to this many bytes...
+LOG_BUFFER_SIZE = 64 * 1024
+# ... or for this many seconds, whichever comes first
+LOG_FLUSH_INTERVAL = 0.1
 
-def debug(log, _, __):
-    """Log the stack traces of all threads"""
-    for th in threading.enumerate():
-        log.warning(
-            "SIGUSR1 received, dumping stack trace",
-            thread=th.name,
-            traceback="".join(traceback.format_stack(sys._current_frames()[th.ident])),
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """A RotatingFileHandler which doesn't flush after every record.
+
+    Records are written out when LOG_BUFFER_SIZE bytes have built up, every
+    LOG_FLUSH_INTERVAL seconds, and when the handler is closed."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._closed = threading.Event()
+        threading.Thread(
+            target=self._flush_periodically, name="log-flusher", daemon=True
+        ).start()
+
+    def _open(self):
+        return open(
+            self.baseFilename,
+            self.mode,
+            buffering=LOG_BUFFER_SIZE,
+            encoding=self.encoding,
+            errors=self.errors,
         )
 
+    def _flush_periodically(self):
+        while not self._closed.wait(LOG_FLUSH_INTERVAL):
+            super().flush()
+
+    def flush(self):
+        # emit() calls this after every record, leave it to the flusher thread
+        pass
+
+    def close(self):
+        self._closed.set()
+        super().close()
+
 
-def listen(log):
-    signal.signal(signal.SIGUSR1, partial(debug, log))  # Register handler
+def json_dumps(obj, **kwargs):
+    return orjson.dumps(obj, **kwargs).decode("utf-8")
 
 
 async def main():
@@ -74,61 +106,72 @@ async def main():
     if args.packageset is None:
         args.packageset = []
 
+    # The handlers do their writing on the listener's thread, so logging never
+    # blocks the event loop or the workers
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if args.log_directory:
+        handlers.append(
+            BufferedRotatingFileHandler(
+                os.path.join(args.log_directory, "prometheus-launchpad-exporter.log"),
+                maxBytes=10000000,
+                backupCount=5,
+                mode="w",
+            )
+        )
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+
     logging.basicConfig(
         format="%(message)s",
-        level=logging.DEBUG,
-        handlers=[
-            logging.StreamHandler(sys.stderr),
-        ]
-        + (
-            [
-                logging.handlers.RotatingFileHandler(
-                    os.path.join(
-                        args.log_directory, "prometheus-launchpad-exporter.log"
-                    ),
-                    maxBytes=10000000,
-                    backupCount=5,
-                    mode="w",
-                )
-            ]
-            if args.log_directory
-            else []
-        ),
-    ),
+        level=logging.DEBUG if args.debug else logging.INFO,
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+    )
 
     structlog.configure(
         processors=[
-            structlog.contextvars.merge_contextvars,
             structlog.processors.add_log_level,
             structlog.processors.StackInfoRenderer(),
             structlog.dev.set_exc_info,
+            structlog.processors.format_exc_info,
             structlog.processors.TimeStamper(),
-            structlog.processors.LogfmtRenderer(sort_keys=True),
+            structlog.processors.JSONRenderer(
+                serializer=json_dumps, option=orjson.OPT_SORT_KEYS
+            ),
         ],
         wrapper_class=structlog.make_filtering_bound_logger(
             logging.DEBUG if args.debug else logging.INFO
         ),
         context_class=dict,
+        # hand the rendered messages to the logging module, so that they go
+        # through the queue to the listener's thread
         logger_factory=structlog.stdlib.LoggerFactory(),
         cache_logger_on_first_use=True,
     )
 
+    # Dump the stack traces of all threads to stderr on SIGUSR1 (and on crashes)
+    faulthandler.enable()
+    faulthandler.register(signal.SIGUSR1, file=sys.stderr, all_threads=True)
+
     log = structlog.get_logger()
-    listen(log)
     log.debug("Running in debug mode")
 
-    loop = asyncio.get_event_loop()
+    # Cancel ourselves on SIGINT/SIGTERM, and shut down cleanly from here.
+    # These go in before Metrics logs in to Launchpad, so that interrupting
+    # that is handled the same way.
+    main_task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for signal_enum in [SIGINT, SIGTERM]:
+        loop.add_signal_handler(signal_enum, main_task.cancel)
 
     app = Metrics(log, args.series, args.packageset)
 
-    for signal_enum in [SIGINT, SIGTERM]:
-        loop.add_signal_handler(signal_enum, app.stop)
-
-    await app.start()
+    try:
+        await app.start()
+    except asyncio.CancelledError:
+        await app.stop()
 
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        pass
+    asyncio.run(main())
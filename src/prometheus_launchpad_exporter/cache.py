@@ -0,0 +1,152 @@
+# This file is part of prometheus-launchpad-exporter.
+#
+# Copyright (C) 2022 Iain Lane <iain@orangesquash.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import deque, namedtuple
+
+import cachetools
+
+CacheMetrics = namedtuple(
+    "CacheMetrics", ["hits", "misses", "evictions", "entry_age_on_eviction"]
+)
+
+
+class LRUKCache(cachetools.TTLCache):
+    """A TTL cache which evicts using LRU-K instead of LRU.
+
+    The entry evicted is the one whose K-th most recent access is the oldest.
+    Entries which haven't been accessed K times yet go first, least recently
+    used first, so a sweep over lots of keys which are each only looked at once
+    can't push out the entries which are used all the time."""
+
+    def __init__(self, maxsize, ttl, k=2, timer=time.monotonic, getsizeof=None):
+        super().__init__(maxsize, ttl, timer, getsizeof)
+        self._k = k
+        self._history = {}
+
+    def _touch(self, key):
+        try:
+            history = self._history[key]
+        except KeyError:
+            history = self._history[key] = deque(maxlen=self._k)
+        history.append(self.timer())
+
+    def _eviction_order(self, key):
+        history = self._history[key]
+        if len(history) < self._k:
+            return (float("-inf"), history[-1])
+        return (history[0], history[-1])
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._touch(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._touch(key)
+
+    def __delitem__(self, key):
+        self._history.pop(key, None)
+        super().__delitem__(key)
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        # only walk the keys if something has actually gone
+        if len(self._history) > cachetools.Cache.__len__(self):
+            for key in self._history.keys() - cachetools.Cache.__iter__(self):
+                del self._history[key]
+        return expired
+
+    def popitem(self):
+        """Remove and return the `(key, value)` pair with the oldest K-th most
+        recent access that has not already expired."""
+        with self.timer as time:
+            self.expire(time)
+            try:
+                key = min(self, key=self._eviction_order)
+            except ValueError:
+                raise KeyError("%s is empty" % type(self).__name__) from None
+            value = super().__getitem__(key)
+            del self[key]
+            return (key, value)
+
+
+class InstrumentedCache:
+    """Mixin which records the hits, misses and evictions of a cachetools cache
+    in the Prometheus collectors of a CacheMetrics, labelled with the cache's
+    name. metrics can be None, in which case nothing is recorded."""
+
+    def __init__(self, name, metrics, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._labels = {"cache": name}
+        self._metrics = metrics
+        self._inserted = {}
+        self._evicting = False
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        # popitem() looks the victim up on its way out; that's not a hit
+        if self._metrics is not None and not self._evicting:
+            self._metrics.hits.inc(self._labels)
+        return value
+
+    def __missing__(self, key):
+        if self._metrics is not None:
+            self._metrics.misses.inc(self._labels)
+        return super().__missing__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._inserted[key] = time.monotonic()
+
+    def __delitem__(self, key):
+        inserted = self._inserted.pop(key, None)
+        super().__delitem__(key)
+        if self._metrics is not None and self._evicting:
+            self._metrics.evictions.inc(self._labels)
+            if inserted is not None:
+                self._metrics.entry_age_on_eviction.observe(
+                    self._labels, time.monotonic() - inserted
+                )
+
+    def expire(self, time=None):
+        # TTLCache.expire() drops entries without going through __delitem__
+        expired = super().expire(time)
+        if len(self._inserted) > cachetools.Cache.__len__(self):
+            for key in self._inserted.keys() - cachetools.Cache.__iter__(self):
+                del self._inserted[key]
+        return expired
+
+    def popitem(self):
+        self._evicting = True
+        try:
+            return super().popitem()
+        finally:
+            self._evicting = False
+
+
+class InstrumentedLRUCache(InstrumentedCache, cachetools.LRUCache):
+    pass
+
+
+class InstrumentedTTLCache(InstrumentedCache, cachetools.TTLCache):
+    pass
+
+
+class InstrumentedLRUKCache(InstrumentedCache, LRUKCache):
+    pass
@@ -15,24 +15,132 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import os
+import queue
+import sys
+import threading
+from urllib.parse import urlencode
 
 import cachetools.func
+import orjson
 from launchpadlib.launchpad import Launchpad
 
+from .cache import InstrumentedLRUCache, InstrumentedLRUKCache, InstrumentedTTLCache
+
+# Launchpad pages collections 75 entries at a time unless asked for more, and
+# will hand out at most this many entries in one page
+MAX_PAGE_SIZE = 300
+
+# Series in any of these states are the ones people care about
+_ACTIVE_STATUSES = frozenset(
+    {
+        "Active Development",
+        "Current",
+        "Future",
+        "Pre-release Freeze",
+        "Supported",
+    }
+)
+
+# The most idle connections to Launchpad that are kept open for reuse
+HTTP_POOL_SIZE = 50
+
+_shared_lp = None
+_shared_lp_lock = threading.Lock()
+
+
+def _packageset_key(packageset):
+    return (packageset.distroseries.name, packageset.name)
+
+
+class _HttpPool:
+    """Stands in for the httplib2.Http of a launchpadlib browser, lending each
+    request an Http from a pool of copies made the same way as the original.
+    httplib2 isn't thread safe, but this means one Launchpad object can be
+    shared by all the threads.
+
+    The Http objects outlive the threads that use them, so their keep-alive
+    connections to Launchpad are reused by the next pool of workers rather
+    than being thrown away and set up again. At most maxsize idle ones are
+    kept."""
+
+    def __init__(self, launchpad, http, maxsize=HTTP_POOL_SIZE):
+        self._launchpad = launchpad
+        self._http = http
+        self._idle = queue.LifoQueue(maxsize)
+        self._idle.put(http)
+
+    def _get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            http = self._http
+            return self._launchpad.httpFactory(
+                http.authorizer, http.cache, http.timeout, http.proxy_info
+            )
+
+    def request(self, *args, **kwargs):
+        http = self._get()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            try:
+                self._idle.put_nowait(http)
+            except queue.Full:
+                http.close()
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
 
 class LP:
-    def __init__(self, log, cache_dir=None):
-        self.log = log
+    @classmethod
+    def shared(cls, log, metrics=None):
+        """Return the LP used by the whole process, creating it on first use"""
+        global _shared_lp
+        with _shared_lp_lock:
+            if _shared_lp is None:
+                _shared_lp = cls(log, metrics=metrics)
+            return _shared_lp
+
+    def __init__(self, log, cache_dir=None, metrics=None):
+        self.log = log.bind(component="launchpad")
+        # structlog drops debug messages only once their arguments have been
+        # built. --debug sets the level of the logging module too, and that we
+        # can ask up front.
+        self._log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
-        self.series_cache = cachetools.LRUCache(maxsize=512)
-        self.series_arch_cache = cachetools.LRUCache(maxsize=512)
-        self.packageset_cache = cachetools.TTLCache(maxsize=512, ttl=10 * 60)
-        self.packageset_sources_cache = cachetools.TTLCache(maxsize=512, ttl=60 * 60)
+        self.series_cache = InstrumentedLRUCache("series", metrics, maxsize=512)
+        self.series_arch_cache = InstrumentedLRUCache(
+            "series_arch", metrics, maxsize=512
+        )
+        self.packageset_cache = InstrumentedTTLCache(
+            "packageset", metrics, maxsize=512, ttl=10 * 60
+        )
+        # LRU-K so that sweeps over every packageset don't push out the ones
+        # we look at on every refresh
+        self.packageset_sources_cache = InstrumentedLRUKCache(
+            "packageset_sources", metrics, maxsize=512, ttl=60 * 60, k=2
+        )
+        # (ETag, sources) of each packageset, kept for longer than the above
+        # so that once an entry expires there we can ask LP whether it changed
+        # rather than downloading and parsing it again
+        self.packageset_sources_validators = InstrumentedLRUKCache(
+            "packageset_sources_validators",
+            metrics,
+            maxsize=512,
+            ttl=24 * 60 * 60,
+            k=2,
+        )
         # 1 minute expiry on the queues, they move fast
-        self.queue_cache = cachetools.TTLCache(maxsize=512, ttl=1 * 60)
-        self.archive_cache = cachetools.LRUCache(maxsize=1)
-        self.distribution_cache = cachetools.LRUCache(maxsize=1)
+        self.queue_cache = InstrumentedTTLCache(
+            "queue", metrics, maxsize=512, ttl=1 * 60
+        )
+
+        # the caches are shared between threads, and cachetools' aren't safe
+        # to use from more than one at a time
+        self._cache_lock = threading.Lock()
 
         self.cache_dir = cache_dir
         if cache_dir is None:
@@ -48,36 +156,30 @@ class LP:
 
     @property
     def all_current_series_names(self):
-        ubuntu = self.get_distribution("ubuntu")
-        return [
-            series.name
-            for series in ubuntu.series
-            if series.status
-            in (
-                "Active Development",
-                "Current",
-                "Future",
-                "Pre-release Freeze",
-                "Supported",
-            )
-        ]
+        names = []
+        for series in self._ubuntu.series:
+            if series.status not in _ACTIVE_STATUSES:
+                continue
+            # the collection has the series' full representations, so seed
+            # get_series()'s cache with them rather than having it fetch each
+            # series again one at a time
+            key = cachetools.keys.hashkey(series.name)
+            with self._cache_lock:
+                if key not in self.series_cache:
+                    self.series_cache[key] = series
+            names.append(series.name)
+        return names
 
     @cachetools.cachedmethod(
-        lambda self: self.distribution_cache,
+        lambda self: self.series_cache, lock=lambda self: self._cache_lock
     )
-    def get_distribution(self, distribution_name):
-        self.log.debug(
-            "getting distribution from LP", distribution_name=distribution_name
-        )
-        return self.lp.distributions[distribution_name]
-
-    @cachetools.cachedmethod(lambda self: self.series_cache)
     def get_series(self, name):
         self.log.debug("getting series from LP", name=name)
-        ubuntu = self.get_distribution("ubuntu")
-        return ubuntu.getSeries(name_or_version=name)
+        return self._ubuntu.getSeries(name_or_version=name)
 
-    @cachetools.cachedmethod(lambda self: self.series_arch_cache)
+    @cachetools.cachedmethod(
+        lambda self: self.series_arch_cache, lock=lambda self: self._cache_lock
+    )
     def get_series_architectures(self, series_name):
         self.log.debug("getting series architectures from LP", series=series_name)
         series = self.get_series(series_name)
@@ -85,21 +187,59 @@ class LP:
 
     @cachetools.cachedmethod(
         lambda self: self.packageset_cache,
+        lock=lambda self: self._cache_lock,
     )
     def get_all_packagesets_for_series(self, series):
         self.log.debug("getting packagesets from LP", series=series)
-        return self.lp.packagesets.getBySeries(distroseries=self.get_series(series))
-
-    def get_packagesets_by_name(self, series, name):
-        return self.lp.packagesets.getByName(distroseries=series, name=name)
+        return list(
+            self.iter_collection(
+                self.lp.packagesets.getBySeries(distroseries=self.get_series(series))
+            )
+        )
 
     @cachetools.cachedmethod(
         lambda self: self.packageset_sources_cache,
-        key=lambda _, packageset: f"{packageset.distroseries.name}/{packageset.name}",
+        key=lambda _, packageset: _packageset_key(packageset),
+        lock=lambda self: self._cache_lock,
     )
     def get_packageset_sources(self, packageset):
         self.log.debug("getting packageset sources from LP", packageset=packageset.name)
-        s = packageset.getSourcesIncluded()
+        key = _packageset_key(packageset)
+        # not .get(), which doesn't call __missing__ and so wouldn't count misses
+        with self._cache_lock:
+            try:
+                validator = self.packageset_sources_validators[key]
+            except KeyError:
+                validator = None
+        headers = {} if validator is None else {"If-None-Match": validator[0]}
+
+        # This is what packageset.getSourcesIncluded() does, but with a
+        # conditional request
+        browser = self.lp._browser
+        response, content = browser._request(
+            f"{packageset.self_link}?ws.op=getSourcesIncluded", extra_headers=headers
+        )
+        # httplib2 has its own on-disk cache. If it has a copy, it turns LP's
+        # 304 into a 200 with that copy's body, which has the same ETag as our
+        # validator if it's the list we already parsed.
+        not_modified = content is browser.NOT_MODIFIED or (
+            validator is not None
+            and response.fromcache
+            and response.get("etag") == validator[0]
+        )
+        if not_modified:
+            self.log.debug(
+                "packageset sources not modified on LP", packageset=packageset.name
+            )
+            return validator[1]
+
+        # The same packages turn up in lots of packagesets and series, so
+        # share one copy of each name
+        s = tuple(sys.intern(name) for name in orjson.loads(content))
+        etag = response.get("etag")
+        if etag is not None:
+            with self._cache_lock:
+                self.packageset_sources_validators[key] = (etag, s)
         self.log.debug(
             "done getting packageset sources from LP", packageset=packageset.name
         )
@@ -107,33 +247,45 @@ class LP:
 
     @cachetools.cachedmethod(
         lambda self: self.queue_cache,
-        key=lambda _, series, status, pocket: f"{series.name}/{status}/{pocket}",
+        key=lambda _, series, status, pocket: (series.name, status, pocket),
+        lock=lambda self: self._cache_lock,
     )
-    def get_queue(self, series, status, pocket):
+    def get_queue_size(self, series, status, pocket):
         self.log.debug(
             "getting queues from LP", series=series.name, status=status, pocket=pocket
         )
-        return series.getPackageUploads(status=status, pocket=pocket)
-
-    @cachetools.cachedmethod(
-        lambda self: self.archive_cache,
-        key=lambda _, distribution: distribution.name,
-    )
-    def main_archive(self, distribution):
-        self.log.debug("getting main archive from LP", distribution=distribution.name)
-        return distribution.main_archive
-
-    def get_published_sources(self, pocket, source_name, series, created_since_date):
-        self.log.debug(
-            "getting published sources from LP",
-            pocket=pocket,
-            source_name=source_name,
-            series=series.name,
-            created_since_date=created_since_date,
+        # We only want to know how many uploads there are, so ask for a page of
+        # one rather than downloading the first 75 just to count them
+        query = urlencode(
+            {
+                "ws.op": "getPackageUploads",
+                "status": status,
+                "pocket": pocket,
+                "ws.size": 1,
+            }
         )
-        ubuntu = self.get_distribution("ubuntu")
-        ubuntu_archive = self.main_archive(ubuntu)
-        return ubuntu_archive.getPublishedSources(
+        page = orjson.loads(self.lp._browser.get(f"{series.self_link}?{query}"))
+        try:
+            return page["total_size"]
+        except KeyError:
+            # LP sends a link instead when the count is expensive
+            return orjson.loads(self.lp._browser.get(page["total_size_link"]))
+
+    def get_latest_published_source(
+        self, pocket, source_name, series, created_since_date
+    ):
+        """Return the newest publication of source_name created since
+        created_since_date, or None if there isn't one"""
+        # not cached, so this is called for every source in every pocket
+        if self._log_debug:
+            self.log.debug(
+                "getting published sources from LP",
+                pocket=pocket,
+                source_name=source_name,
+                series=series.name,
+                created_since_date=created_since_date,
+            )
+        spphs = self._ubuntu_archive.getPublishedSources(
             exact_match=True,
             pocket=pocket,
             source_name=source_name,
@@ -142,6 +294,29 @@ class LP:
             order_by_date=True,
             status="Published",
         )
+        # newest first, so this is all of the first page we need
+        return next(iter(spphs), None)
+
+    def get_published_binaries(self, spph):
+        return self.iter_collection(spph.getPublishedBinaries())
+
+    def iter_collection(self, collection):
+        """Iterate over a launchpadlib collection.
+
+        launchpadlib follows the links the server hands out, which means
+        fetching every page after the first one 75 entries at a time. Ask for
+        MAX_PAGE_SIZE entries per page instead."""
+        collection._ensure_representation()
+        page = collection._wadl_resource.representation
+        while True:
+            yield from collection._convert_dicts_to_entries(page.get("entries", []))
+            next_link = page.get("next_collection_link")
+            if next_link is None:
+                return
+            next_link = collection._with_url_query_variable_set(
+                next_link, "ws.size", MAX_PAGE_SIZE
+            )
+            page = orjson.loads(self.lp._browser.get(next_link))
 
     def login(self):
         self.lp = Launchpad.login_anonymously(
@@ -150,3 +325,8 @@ class LP:
             self.cache_dir,
             version="devel",
         )
+        browser = self.lp._browser
+        browser._connection = _HttpPool(self.lp, browser._connection)
+        # these never change, so look them up once
+        self._ubuntu = self.lp.distributions["ubuntu"]
+        self._ubuntu_archive = self._ubuntu.main_archive
@@ -16,144 +16,230 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import threading
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-from aioprometheus import Gauge
+from aioprometheus import Counter, Gauge, Histogram
 from aioprometheus.service import Service
 
+from .cache import CacheMetrics
 from .launchpad import LP
-from .ubuntu import UbuntuMetrics
+from .ubuntu import POCKETS, UbuntuMetrics
+
+# How many threads do blocking Launchpad work for the event loop
+MAX_WORKERS = 8
+
+
+class SnapshotGauge(Gauge):
+    """A Gauge whose samples are all replaced at once.
+
+    Gauge.set() validates and serialises the labels of each sample as it's
+    set. This keeps a plain dict of label values -> value instead, which is
+    swapped in whole by set_all(), and only builds the labels when scraped.
+    Label sets missing from the new samples stop being exported."""
+
+    def __init__(self, name, doc, label_names):
+        super().__init__(name, doc)
+        self._label_names = label_names
+        self._samples = {}
+
+    def set_all(self, samples):
+        """Replace the samples with samples, which maps tuples of label values
+        (in the order of label_names) to values"""
+        self._samples = samples
+
+    def get_all(self):
+        return [
+            (dict(zip(self._label_names, label_values)), value)
+            for label_values, value in self._samples.items()
+        ]
 
 
 class Metrics:
     def __init__(self, log, series, packagesets):
-        self.log = log
-        log.info("Starting prometheus-launchpad-exporter")
+        self.log = log.bind(component="metrics")
+        self.log.info("Starting prometheus-launchpad-exporter")
 
-        self._series = series
-        self._packagesets = packagesets
+        self.cache_metrics = CacheMetrics(
+            hits=Counter(
+                "lp_cache_hits_total",
+                "Number of lookups answered from a Launchpad cache",
+            ),
+            misses=Counter(
+                "lp_cache_misses_total",
+                "Number of lookups which had to go to Launchpad",
+            ),
+            evictions=Counter(
+                "lp_cache_evictions_total",
+                "Number of entries evicted from a Launchpad cache to make room",
+            ),
+            entry_age_on_eviction=Histogram(
+                "lp_cache_entry_age_on_eviction_seconds",
+                "Age of Launchpad cache entries when they were evicted",
+                buckets=(1, 10, 60, 5 * 60, 10 * 60, 30 * 60, 60 * 60, float("inf")),
+            ),
+        )
 
-        self._lp = LP(log)
+        self._lp = LP.shared(log, metrics=self.cache_metrics)
 
-        self._metrics = UbuntuMetrics(log, series, packagesets)
+        self._metrics = UbuntuMetrics(log, self._lp, series, packagesets)
 
         self._service = Service()
-        self.packageset_number_packages = Gauge(
+        self.packageset_number_packages = SnapshotGauge(
             "packageset_number_packages",
             "Number of packages in a packageset",
+            ("series", "packageset"),
         )
-        self.packageset_failed_builds = Gauge(
+        self.packageset_failed_builds = SnapshotGauge(
             "packageset_failed_builds",
             "Number of failed builds in a packageset",
+            ("series", "packageset", "pocket", "arch"),
         )
-        self.queue_number_packages = Gauge(
+        self.queue_number_packages = SnapshotGauge(
             "queue_number_packages",
             "Number of packages in a queue",
+            ("series", "pocket", "status"),
         )
         self._stop_metrics_refresh_timer = threading.Event()
-        self._stop_fetch_build_statuses_timer = threading.Event()
+        self._stop_fetch_build_statuses_timer = asyncio.Event()
+        # shared by everything the event loop hands off to a thread, except
+        # for the long-running refresh timer
+        self._executor = ThreadPoolExecutor(
+            max_workers=MAX_WORKERS, thread_name_prefix="metrics"
+        )
+
+    async def _run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
 
     def update_packageset_count_metrics(self):
-        # initialize the metrics to 0
-        failed_builds = {}
-        for series in self._metrics.series_to_consider(self._lp):
+        # (series, packageset, pocket, arch) -> number of failed builds
+        failed_builds = collections.Counter()
+
+        # initialize the metrics to 0, so that fixed builds go back to 0
+        for series in self._metrics.series_to_consider():
             arches = self._lp.get_series_architectures(series)
-            failed_builds[series] = {}
-            for packageset in self._metrics.packagesets_to_consider_for_series(
-                self._lp, series
-            ):
+            for packageset in self._metrics.packagesets_to_consider_for_series(series):
                 for arch in arches:
-                    for pocket in (
-                        "Backports",
-                        "Proposed",
-                        "Release",
-                        "Security",
-                        "Updates",
-                    ):
-                        failed_builds[series].setdefault(packageset, {}).setdefault(
-                            pocket, {}
-                        )[arch] = 0
+                    for pocket in POCKETS:
+                        failed_builds[(series, packageset.name, pocket, arch)] = 0
 
+        number_packages = {}
         for series, packagesets in self._metrics.series_packageset_source_map.items():
             for packageset, sources in packagesets.items():
-                self.packageset_number_packages.set(
-                    {"series": series, "packageset": packageset}, len(sources)
-                )
+                number_packages[(series, packageset)] = len(sources)
                 for source in sources:
-                    fbs = source.get_failed_builds()
-                    for pocket in fbs:
-                        for arch in fbs[pocket]:
-                            failed_builds[series][packageset][pocket][arch] += 1
-
-        for series, packagesets in failed_builds.items():
-            for packageset, pockets in packagesets.items():
-                for pocket, arches in pockets.items():
-                    for arch, count in arches.items():
-                        self.packageset_failed_builds.set(
-                            {
-                                "series": series,
-                                "packageset": packageset,
-                                "pocket": pocket,
-                                "arch": arch,
-                            },
-                            count,
-                        )
+                    for pocket, arch in source.get_failed_builds():
+                        failed_builds[(series, packageset, pocket, arch)] += 1
+
+        self.packageset_number_packages.set_all(number_packages)
+        self.packageset_failed_builds.set_all(failed_builds)
 
     def update_queue_metrics(self):
-        for series, queues in self._metrics.series_queue_count_map.items():
-            for pocket, statuses in queues.items():
-                for status, n_packages in statuses.items():
-                    self.queue_number_packages.set(
-                        {"series": series, "pocket": pocket, "status": status},
-                        n_packages,
-                    )
+        self.queue_number_packages.set_all(
+            {
+                (series, pocket, status): n_packages
+                for series, queues in self._metrics.series_queue_count_map.items()
+                for pocket, statuses in queues.items()
+                for status, n_packages in statuses.items()
+            }
+        )
+
+    def refresh_metrics(self):
+        self.log.info("Refreshing metrics")
+
+        # the queues don't depend on the packagesets, fetch them meanwhile
+        queues = self._executor.submit(self._metrics.fetch_queues)
+        try:
+            self._metrics.populate_packageset_maps()
+        finally:
+            # wait for it even if the packagesets failed, rather than leaving
+            # it running behind the next refresh
+            queues.result()
+
+        self.update_packageset_count_metrics()
+        self.update_queue_metrics()
 
     def refresh_metrics_timer(self):
         while not self._stop_metrics_refresh_timer.is_set():
             if self._stop_metrics_refresh_timer.wait(60):
                 return
-            self.log.info("Refreshing metrics")
+            try:
+                self.refresh_metrics()
+            except RuntimeError:
+                # stop() can shut the pools down after we've woken up, and
+                # then they refuse any more work
+                if self._stop_metrics_refresh_timer.is_set():
+                    return
+                raise
 
-            self._metrics.populate_packageset_maps()
-            self._metrics.fetch_queues()
+    async def _gather_build_statuses(self, all_series, fetches):
+        results = await asyncio.gather(*fetches, return_exceptions=True)
+        for series, result in zip(all_series, results):
+            if isinstance(result, Exception):
+                self.log.error(
+                    "failed to fetch build statuses", series=series, exc_info=result
+                )
 
-            self.update_packageset_count_metrics()
-            self.update_queue_metrics()
+    async def fetch_build_statuses(self):
+        all_series = await self._run_in_executor(self._metrics.series_to_consider)
+        await self._gather_build_statuses(
+            all_series,
+            [
+                self._run_in_executor(self._metrics.fetch_build_statuses, series)
+                for series in all_series
+            ],
+        )
 
-    def fetch_build_statuses(self, series):
-        while not self._stop_fetch_build_statuses_timer.is_set():
-            if self._stop_fetch_build_statuses_timer.wait(60 * 5):
+    async def fetch_build_statuses_timer(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._stop_fetch_build_statuses_timer.wait(), 60 * 5
+                )
                 return
-            self._metrics.fetch_build_statuses(series)
+            except asyncio.TimeoutError:
+                await self.fetch_build_statuses()
 
     async def start(self):
-        # make sure the metrics are fetched once before we start
-        self._metrics.populate_packageset_maps()
-        self._metrics.fetch_queues()
-
-        threads = []
-        for series in self._metrics.series_to_consider(self._lp):
-            t = threading.Thread(
-                target=partial(self._metrics.fetch_build_statuses, series)
+        # make sure the metrics are fetched once before we start. The queues
+        # can be fetched while everything else is going. The build statuses
+        # of a series need its packagesets, so start on them as soon as each
+        # series' packagesets are in, while the other series are still going.
+        build_statuses = {}
+
+        def fetch_build_statuses(series_name):
+            # called on the thread running populate_packageset_maps
+            build_statuses[series_name] = self._executor.submit(
+                self._metrics.fetch_build_statuses, series_name
             )
-            threads.append(t)
-            t.start()
 
-        for t in threads:
-            t.join()
+        queues = self._executor.submit(self._metrics.fetch_queues)
+        try:
+            await self._run_in_executor(
+                self._metrics.populate_packageset_maps, fetch_build_statuses
+            )
+            await self._gather_build_statuses(
+                list(build_statuses),
+                [asyncio.wrap_future(f) for f in build_statuses.values()],
+            )
+        except BaseException:
+            queues.cancel()
+            for future in build_statuses.values():
+                future.cancel()
+            raise
+        await asyncio.wrap_future(queues)
 
-        self.update_packageset_count_metrics()
-        self.update_queue_metrics()
+        await self._run_in_executor(self.update_packageset_count_metrics)
+        await self._run_in_executor(self.update_queue_metrics)
 
         metrics_refresh_timer = asyncio.to_thread(self.refresh_metrics_timer)
 
         # refresh every minute
         await asyncio.gather(
-            *[
-                asyncio.to_thread(partial(self.fetch_build_statuses, series))
-                for series in self._metrics.series_to_consider(self._lp)
-            ],
+            self.fetch_build_statuses_timer(),
             metrics_refresh_timer,
             self._service.start(addr="0.0.0.0", port=8000),
         )
@@ -162,7 +248,10 @@ class Metrics:
     # we still need to add a lot of event checking inside of fetch_metrics() to
     # interrupt it. It works now but the interrupt doesn't happen until the sync
     # calls finish
-    def stop(self):
+    async def stop(self):
         self.log.info("Stopping prometheus-launchpad-exporter")
         self._stop_metrics_refresh_timer.set()
         self._stop_fetch_build_statuses_timer.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._metrics.close()
+        await self._service.stop()
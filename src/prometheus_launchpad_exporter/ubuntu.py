@@ -16,12 +16,43 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import concurrent.futures
+import sys
 import threading
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import lazr.restfulclient.errors
 
-from .launchpad import LP
+POCKETS = ("Backports", "Proposed", "Release", "Security", "Updates")
+
+# How many threads make requests to Launchpad, shared by all of the phases
+MAX_WORKERS = 50
+
+
+def _map_window(executor, fn, iterable, buffersize):
+    pending = deque()
+    try:
+        for item in iterable:
+            if len(pending) >= buffersize:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _bounded_map(executor, fn, iterable, buffersize):
+    """Like executor.map(fn, iterable), but with no more than buffersize calls
+    submitted whose results haven't been consumed yet, rather than submitting
+    everything up front and holding on to all of the results.
+
+    As with executor.map(), an exception from fn is raised when its result is
+    reached, and nothing more is submitted after that, so callers which want
+    every item processed have to handle errors inside fn."""
+    if sys.version_info >= (3, 14):
+        return executor.map(fn, iterable, buffersize=buffersize)
+    return _map_window(executor, fn, iterable, buffersize)
 
 
 class SourcePackage:
@@ -34,41 +65,49 @@ class SourcePackage:
         self._series_name = series_name
 
         self._last_time_checked = {}
-        self._build_status = defaultdict(lambda: defaultdict(str))
+        # (pocket, arch) -> (version, state)
+        self._build_status = {}
+        # pocket -> how many of the above aren't "Successfully built"
+        self._unsuccessful_builds = {}
 
     @property
     def name(self):
         return self._name
 
     def _any_builds_not_successful(self, pocket):
-        return any(
-            state != "Successfully built"
-            for _, state in self._build_status[pocket].values()
-        )
+        return self._unsuccessful_builds.get(pocket, 0) > 0
+
+    def _set_build_status(self, pocket, arch, version, state):
+        old = self._build_status.get((pocket, arch))
+        self._build_status[(pocket, arch)] = (version, state)
+
+        # Only this pocket's fetch writes to its entries, so there's no need
+        # to lock this
+        change = int(state != "Successfully built")
+        if old is not None:
+            change -= int(old[1] != "Successfully built")
+        if change:
+            self._unsuccessful_builds[pocket] = (
+                self._unsuccessful_builds.get(pocket, 0) + change
+            )
 
     def get_failed_builds(self):
+        """(pocket, arch) -> (version, state) of the builds which failed"""
         return {
-            pocket: {
-                arch: (version, state)
-                for arch, (version, state) in builds.items()
-                if state == "Failed to build"
-            }
-            for pocket, builds in self._build_status.items()
+            pocket_arch: (version, state)
+            for pocket_arch, (version, state) in list(self._build_status.items())
+            if state == "Failed to build"
         }
 
-    def _fetch_latest_build_status_pocket(self, pocket, local):
-        log = self.log.bind(pocket=pocket)
-        lp = local.lp
-        series = lp.get_series(self._series_name)
-        try:
-            latest_spph = lp.get_published_sources(
-                pocket,
-                self._name,
-                series,
-                self._last_time_checked.get(pocket, None),
-            )[0]
-        except IndexError:
-            log.debug("No published sources found")
+    def _fetch_latest_build_status_pocket(self, pocket, lp, series):
+        latest_spph = lp.get_latest_published_source(
+            pocket,
+            self._name,
+            series,
+            self._last_time_checked.get(pocket, None),
+        )
+        if latest_spph is None:
+            self.log.debug("No published sources found", pocket=pocket)
             return
 
         # If we've already seen this one, and all of the builds were successful,
@@ -76,7 +115,7 @@ class SourcePackage:
         if latest_spph.date_created == self._last_time_checked.get(
             pocket, None
         ) and not self._any_builds_not_successful(pocket):
-            log.debug("all builds successful, skipping")
+            self.log.debug("all builds successful, skipping", pocket=pocket)
             return
 
         self._last_time_checked[pocket] = latest_spph.date_created
@@ -84,36 +123,40 @@ class SourcePackage:
         try:
             build_records = latest_spph.getBuilds()
         except lazr.restfulclient.errors.Unauthorized:
-            log.warning("Unauthorized to fetch builds")
+            self.log.warning("Unauthorized to fetch builds", pocket=pocket)
             return
 
         # if this package was built in this series (wasn't copied forward), then
         # there will be build records
         # (https://bugs.launchpad.net/launchpad/+bug/783613)...
         if len(build_records) > 0:
-            log.debug("found build records", count=len(build_records))
+            self.log.debug(
+                "found build records", pocket=pocket, count=len(build_records)
+            )
             for record in build_records:
                 arch = record.arch_tag
                 state = record.buildstate
-                log.debug(
+                self.log.debug(
                     "got build status",
+                    pocket=pocket,
                     arch=arch,
                     version=latest_spph.source_package_version,
                     state=state,
                 )
-                self._build_status[pocket][arch] = (
-                    latest_spph.source_package_version,
-                    state,
+                self._set_build_status(
+                    pocket, arch, latest_spph.source_package_version, state
                 )
             return
 
         # ... if it wasn't then there won't be: the way is to go through binary
         # publications to find the build
-        bpphs = latest_spph.getPublishedBinaries()
+        bpphs = lp.get_published_binaries(latest_spph)
 
+        # there can be lots of binaries, but we only need one build per arch
+        expected_arches = set(lp.get_series_architectures(self._series_name))
         seen_arches = set()
 
-        log.debug("no build records, looking through bpphs")
+        self.log.debug("no build records, looking through bpphs", pocket=pocket)
 
         for bpph in bpphs:
             build = bpph.build
@@ -126,29 +169,26 @@ class SourcePackage:
 
             seen_arches.add(arch)
 
-            log.debug(
+            self.log.debug(
                 "got build status",
+                pocket=pocket,
                 arch=arch,
                 version=latest_spph.source_package_version,
                 state=state,
             )
-            self._build_status[pocket][arch] = (
-                latest_spph.source_package_version,
-                state,
+            self._set_build_status(
+                pocket, arch, latest_spph.source_package_version, state
             )
             if state != "Successfully built":
-                log.info(
+                self.log.info(
                     "build not successful",
+                    pocket=pocket,
                     arch=arch,
                     version=latest_spph.source_package_version,
                     state=state,
                 )
-
-    def fetch_latest_build_status(self, local):
-        for pocket in ("Backports", "Proposed", "Release", "Security", "Updates"):
-            self._fetch_latest_build_status_pocket(pocket, local)
-
-        return self._build_status
+            if seen_arches >= expected_arches:
+                break
 
     @property
     def has_any_builds(self):
@@ -156,118 +196,184 @@ class SourcePackage:
 
 
 class UbuntuMetrics:
-    def __init__(self, log, series, packagesets):
-        self._local = threading.local()
-
+    def __init__(self, log, lp, series, packagesets):
         self.log = log
 
         self._series = series
         self._packagesets = packagesets
 
+        self._lp = lp
+        # (series, packageset) we were asked for but which don't exist, so
+        # that they're only warned about once
+        self._missing_packagesets = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_WORKERS, thread_name_prefix="launchpad"
+        )
+
         self._series_queue_count_map = defaultdict(
             lambda: defaultdict(lambda: defaultdict(int))
         )
-        self._series_packageset_source_map = defaultdict(lambda: defaultdict(set))
-        self._series_source_map = defaultdict(dict)
-
-    def series_to_consider(self, lp):
-        return self._series if self._series else lp.all_current_series_names
-
-    def packagesets_to_consider_for_series(self, lp, series_name):
-        return (
-            self._packagesets
-            if self._packagesets
-            else [
-                packageset.name
-                for packageset in lp.get_all_packagesets_for_series(series_name)
-            ]
-        )
-
-        return self._packagesets
+        # series -> packageset -> {SourcePackage}
+        self._series_packageset_source_map = {}
+        # series -> source name -> SourcePackage
+        self._series_source_map = {}
+
+        # bumped whenever the packageset maps or the build statuses change, so
+        # that series_packageset_source_map knows when to rebuild
+        self._map_version = 0
+        self._map_version_lock = threading.Lock()
+        self._cached_series_packageset_source_map = (None, None)
+
+    def _bump_map_version(self):
+        with self._map_version_lock:
+            self._map_version += 1
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def series_to_consider(self):
+        return self._series if self._series else self._lp.all_current_series_names
+
+    def packagesets_to_consider_for_series(self, series_name):
+        packagesets = self._lp.get_all_packagesets_for_series(series_name)
+        if not self._packagesets:
+            return packagesets
+
+        # look the packagesets we were asked for up in the series' list of
+        # them, rather than asking LP for each one by name
+        by_name = {packageset.name: packageset for packageset in packagesets}
+        ret = []
+        for packageset_name in self._packagesets:
+            packageset = by_name.get(packageset_name)
+            if packageset is None:
+                if (series_name, packageset_name) not in self._missing_packagesets:
+                    self._missing_packagesets.add((series_name, packageset_name))
+                    self.log.warning(
+                        "packageset not found",
+                        series=series_name,
+                        packageset=packageset_name,
+                    )
+                continue
+            ret.append(packageset)
+        return ret
 
-    def fetch_packageset_for_series(
-        self,
-        packageset_name,
-        series_name,
-        lock,
-        local,
-    ):
-        lp = local.lp
+    def fetch_packageset_for_series(self, packageset, series_name):
+        lp = self._lp
+        packageset_name = packageset.name
 
         log = self.log.bind(series=series_name, packageset=packageset_name)
 
-        series = lp.get_series(series_name)
-        packageset = lp.get_packagesets_by_name(series, packageset_name)
         sources = lp.get_packageset_sources(packageset)
 
-        source_map = {}
-        packageset_source_map = defaultdict(set)
+        # The previous refresh's map is only ever replaced, never changed, and
+        # everything written here is local to this call, so there's nothing to
+        # lock
+        known_sources = self._series_source_map.get(series_name, {})
+        packageset_sources = set()
 
         log.info("processing packageset", n_sources=len(sources))
         for source in sources:
-            with lock:
-                sp = self._series_source_map[series_name].get(
-                    source, source_map.get(source)
-                )
-                if sp is None:
-                    log = log.bind(source_name=source)
-                    log.debug("creating source package")
-                    sp = SourcePackage(log, source, series_name)
-                source_map[source] = sp
-                packageset_source_map[packageset_name].add(sp)
-
-        return (source_map, packageset_source_map)
-
-    def make_lp(self, local):
+            sp = known_sources.get(source)
+            if sp is None:
+                log.debug("creating source package", source_name=source)
+                sp = SourcePackage(self.log, source, series_name)
+            packageset_sources.add(sp)
+
+        return packageset_sources
+
+    def _fetch_packageset_or_previous(self, packageset, series_name):
+        """fetch_packageset_for_series(), but if that fails log it and carry on
+        with what we had for the packageset last time, so that one bad
+        packageset doesn't stop the rest being fetched"""
         try:
-            lp = local.lp
-            self.log.debug("reusing existing LP connection")
-            return lp
-        except AttributeError:
-            self.log.debug("making new LP")
-            local.lp = LP(self.log)
-            return local.lp
-
-    def populate_packageset_maps(self):
-        lock = threading.Lock()
-
-        series_source_map = defaultdict(dict)
-        series_packageset_source_map = defaultdict(lambda: defaultdict(set))
-
-        local = threading.local()
-
-        lp = self.make_lp(local)
-
-        for series_name in self.series_to_consider(lp):
+            return self.fetch_packageset_for_series(packageset, series_name)
+        except Exception:
+            self.log.exception(
+                "failed to fetch packageset",
+                series=series_name,
+                packageset=packageset.name,
+            )
+            previous = self._series_packageset_source_map.get(series_name, {})
+            return previous.get(packageset.name, set())
+
+    def populate_packageset_maps(self, on_series_done=None):
+        """Fetch the sources of the packagesets in each series.
+
+        Each series' maps are replaced as soon as all of its packagesets are
+        in, and then on_series_done, if given, is called with the series'
+        name, while the remaining series are still being fetched."""
+        # every (series, packageset) goes into the same pool, so that the
+        # series are fetched at the same time as each other
+        series_packagesets = []
+        for series_name in self.series_to_consider():
             self.log.info("fetching packagesets", series=series_name)
 
-            packageset_names = self.packagesets_to_consider_for_series(lp, series_name)
+            packagesets = self.packagesets_to_consider_for_series(series_name)
 
             self.log.info(
                 "got packagesets",
                 series=series_name,
-                packagesets=" ".join(packageset_names),
+                packagesets=" ".join(packageset.name for packageset in packagesets),
             )
 
-            with concurrent.futures.ThreadPoolExecutor(
-                max_workers=10, initializer=self.make_lp, initargs=(local,)
-            ) as executor:
-                for (source_map, packageset_source_map) in executor.map(
-                    lambda packageset_name: self.fetch_packageset_for_series(
-                        packageset_name,
-                        series_name,
-                        lock,
-                        local,
-                    ),
-                    packageset_names,
-                ):
-                    series_source_map[series_name].update(source_map)
-                    series_packageset_source_map[series_name].update(
-                        packageset_source_map
-                    )
+            series_packagesets.append((series_name, packagesets))
+
+        # the results come back in the order of the tasks, so one series at a
+        # time
+        results = iter(
+            _bounded_map(
+                self._executor,
+                lambda task: self._fetch_packageset_or_previous(task[1], task[0]),
+                [
+                    (series_name, packageset)
+                    for series_name, packagesets in series_packagesets
+                    for packageset in packagesets
+                ],
+                buffersize=40,
+            )
+        )
+        for series_name, packagesets in series_packagesets:
+            source_map = {}
+            packageset_source_map = {}
+            for packageset in packagesets:
+                # Packagesets fetched at the same time can each have created a
+                # SourcePackage for a new source they share. Keep the first
+                # one, so that each source is only one object.
+                packageset_source_map[packageset.name] = {
+                    source_map.setdefault(source.name, source)
+                    for source in next(results)
+                }
+
+            # Swap in new dicts rather than changing the ones which other
+            # threads may be reading
+            self._series_source_map = {
+                **self._series_source_map,
+                series_name: source_map,
+            }
+            self._series_packageset_source_map = {
+                **self._series_packageset_source_map,
+                series_name: packageset_source_map,
+            }
+            self._bump_map_version()
 
-        self._series_source_map = series_source_map
-        self._series_packageset_source_map = series_packageset_source_map
+            if on_series_done is not None:
+                on_series_done(series_name)
+
+        # forget any series we're no longer looking at
+        series_names = {series_name for series_name, _ in series_packagesets}
+        self._series_source_map = {
+            series_name: source_map
+            for series_name, source_map in self._series_source_map.items()
+            if series_name in series_names
+        }
+        self._series_packageset_source_map = {
+            series_name: packageset_source_map
+            for series_name, packageset_source_map in (
+                self._series_packageset_source_map.items()
+            )
+            if series_name in series_names
+        }
+        self._bump_map_version()
 
         self.log.info("done fetching packagesets")
         for series_name in self._series_source_map:
@@ -279,59 +385,89 @@ class UbuntuMetrics:
 
         return self._series_source_map
 
+    def _fetch_one_queue(self, series_name, status, pocket):
+        queue_size = self._lp.get_queue_size(
+            self._lp.get_series(series_name), status, pocket
+        )
+        self.log.debug(
+            "got queue",
+            series=series_name,
+            status=status,
+            pocket=pocket,
+            n_queue_items=queue_size,
+        )
+        return (series_name, pocket, status, queue_size)
+
     def fetch_queues(self):
-        local = threading.local()
-        lp = self.make_lp(local)
+        series_names = self.series_to_consider()
+        self.log.info("fetching queues", series=" ".join(series_names))
+        queues = [
+            (series_name, status, pocket)
+            for series_name in series_names
+            for status in ("New", "Unapproved")
+            for pocket in POCKETS
+        ]
+
         # series -> queue -> n_packages
         ret = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-        for series_name in self.series_to_consider(lp):
-            series = lp.get_series(series_name)
-            self.log.info("fetching queues", series=series_name)
-            for status in ("New", "Unapproved"):
-                for pocket in (
-                    "Release",
-                    "Security",
-                    "Updates",
-                    "Proposed",
-                    "Backports",
-                ):
-                    queue = lp.get_queue(series, status, pocket)
-                    self.log.debug(
-                        "got queue",
-                        series=series_name,
-                        status=status,
-                        pocket=pocket,
-                        n_queue_items=len(queue),
-                    )
-                    ret[series_name][pocket][status] = len(queue)
-            self.log.info("done fetching queues", series=series_name)
+        for series_name, pocket, status, queue_size in self._executor.map(
+            lambda queue: self._fetch_one_queue(*queue), queues
+        ):
+            ret[series_name][pocket][status] = queue_size
+        self.log.info("done fetching queues", series=" ".join(series_names))
 
         self._series_queue_count_map = ret
 
+    def _fetch_build_status_pocket(self, source, pocket, series):
+        """Returns whether it worked. Failures are logged rather than raised, so
+        that one bad source doesn't stop the rest being fetched."""
+        try:
+            source._fetch_latest_build_status_pocket(pocket, self._lp, series)
+        except Exception:
+            source.log.exception("failed to fetch build status", pocket=pocket)
+            return False
+        return True
+
     def fetch_build_statuses(self, series_name):
         self.log.info("fetching build statuses", series=series_name)
-        all_sources = [
-            source
-            for _, sources in self._series_packageset_source_map[series_name].items()
-            for source in sources
-        ]
-
-        local = threading.local()
-
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=10, initializer=self.make_lp, initargs=(local,)
-        ) as executor:
-            for source in all_sources:
-                executor.submit(source.fetch_latest_build_status, local)
-
-        self.log.info("done fetching build statuses", series=series_name)
+        # sources are often in more than one packageset, only fetch them once
+        all_sources = set()
+        for sources in self._series_packageset_source_map.get(series_name, {}).values():
+            all_sources.update(sources)
+
+        # every source is in this series, so look it up once for all of them
+        series = self._lp.get_series(series_name)
+
+        # The pockets of a source are independent of each other, so they're
+        # fetched in parallel too. Each one only touches its own pocket's keys
+        # in the SourcePackage.
+        n_failed = 0
+        for ok in _bounded_map(
+            self._executor,
+            lambda task: self._fetch_build_status_pocket(task[0], task[1], series),
+            ((source, pocket) for source in all_sources for pocket in POCKETS),
+            buffersize=100,
+        ):
+            n_failed += not ok
+        self._bump_map_version()
+
+        self.log.info(
+            "done fetching build statuses", series=series_name, n_failed=n_failed
+        )
 
     @property
     def series_packageset_source_map(self):
         """series -> packageset -> source_package.
         Only returns sources that are in the series. Packagesets can contain
         sources that are not in the series."""
-        return {
+        # read the version first: if it changes while we're building the map,
+        # the result is stored against the old one and rebuilt next time
+        version = self._map_version
+        cached_version, cached = self._cached_series_packageset_source_map
+        if cached_version == version:
+            return cached
+
+        result = {
             series: {
                 packageset: [source for source in sources if source.has_any_builds]
                 for packageset, sources in self._series_packageset_source_map[
@@ -340,6 +476,8 @@ class UbuntuMetrics:
             }
             for series in self._series_packageset_source_map
         }
+        self._cached_series_packageset_source_map = (version, result)
+        return result
 
     @property
     def series_queue_count_map(self):